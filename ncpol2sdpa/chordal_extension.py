@@ -38,19 +38,13 @@ def _generate_clique(variables, obj, inequalities, equalities,
     if obj is not None:
         for support in get_support(variables, obj):
             nonzeros = np.nonzero(support)[0]
-            value = random.random()
-            for i in nonzeros:
-                for j in nonzeros:
-                    rmat[i, j] = value
+            rmat[np.ix_(nonzeros, nonzeros)] = random.random()
     # Constraints: if x_i & x_j in support, rmat_ij = rand
     for polynomial in flatten([inequalities, equalities, momentinequalities,
                                momentequalities]):
         support = np.any(get_support(variables, polynomial), axis=0)
         nonzeros = np.nonzero(support)[0]
-        value = random.random()
-        for i in nonzeros:
-            for j in nonzeros:
-                rmat[i, j] = value
+        rmat[np.ix_(nonzeros, nonzeros)] = random.random()
     rmat = rmat + 5*n_dim*np.eye(n_dim)
     # TODO: approximate minimum degree ordering should go before the Cholesky
     # decomposition
@@ -62,12 +56,8 @@ def _generate_clique(variables, obj, inequalities, equalities,
         one = np.nonzero(check_set)[0]
         n_ones = len(one)
         clique_result = np.dot(R[:i, i:n_dim], check_set.T)
-        test = False
-        for t in clique_result:
-            if t == n_ones:
-                test = True
-                break
-        if not test:
+        # The clique is dropped if it is contained in an earlier one
+        if not np.any(clique_result == n_ones):
             remaining_indices.append(i)
     clique_set = R[remaining_indices, :]
     return clique_set
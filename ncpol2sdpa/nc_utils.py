@@ -451,20 +451,22 @@ def get_monomials(variables, degree):
     if not variables:
         return [S.One]
     else:
-        _variables = variables[:]
-        _variables.insert(0, 1)
+        # The Hermiticity of each variable is checked once, not in every
+        # iteration of the product loop
+        adjoints = [None if is_hermitian(var) else var.adjoint()
+                    for var in variables]
+        _variables = [(1, None)] + list(zip(variables, adjoints))
         ncmonomials = [S.One]
         ncmonomials.extend(var for var in variables)
-        for var in variables:
-            if not is_hermitian(var):
-                ncmonomials.append(var.adjoint())
+        ncmonomials.extend(var_adjoint for var_adjoint in adjoints
+                           if var_adjoint is not None)
         for _ in range(1, degree):
             temp = []
-            for var in _variables:
+            for var, var_adjoint in _variables:
                 for new_var in ncmonomials:
                     temp.append(var * new_var)
-                    if var != 1 and not is_hermitian(var):
-                        temp.append(var.adjoint() * new_var)
+                    if var_adjoint is not None:
+                        temp.append(var_adjoint * new_var)
             ncmonomials = unique(temp[:])
         return ncmonomials
 
@@ -624,35 +626,39 @@ def find_variable_set(variable_sets, polynomial):
     return -1
 
 
-def moment_of_entry(pos, monomials, ineq, substitutions):
+def moment_of_entry(pos, monomials, daggered_monomials, ineq, substitutions):
     row = pos[0]
     column = pos[1]
     if isinstance(ineq, str):
         return row, column, ineq
     else:
-        return row, column, simplify_polynomial(monomials[row].adjoint() *
+        return row, column, simplify_polynomial(daggered_monomials[row] *
                                                 ineq * monomials[column],
                                                 substitutions)
 
 
-def assemble_monomial_and_do_substitutions(arg, monomialsA, monomialsB, ppt,
-                                           substitutions,
+def assemble_monomial_and_do_substitutions(arg, monomialsA,
+                                           daggered_monomialsA, productsB,
+                                           ppt, substitutions,
                                            pure_substitution_rules):
     rowA = arg[0]
     columnA = arg[1]
-    rowB = arg[2]
-    columnB = arg[3]
-    if (not ppt) or (columnB >= rowB):
-        monomial = monomialsA[rowA].adjoint() * monomialsA[columnA] * \
-            monomialsB[rowB].adjoint() * monomialsB[columnB]
-    else:
-        monomial = monomialsA[rowA].adjoint() * monomialsA[columnA] * \
-            monomialsB[columnB].adjoint() * monomialsB[rowB]
-        # Apply the substitutions if any
-    monomial = apply_substitutions(monomial, substitutions,
-                                   pure_substitution_rules)
-
-    return columnA, rowB, columnB, monomial
+    # The product of the first party is shared by all entries of the
+    # (rowA, columnA) subblock
+    productA = daggered_monomialsA[rowA] * monomialsA[columnA]
+    lenB = len(productsB)
+    entries = []
+    for rowB in range(lenB):
+        for columnB in range((rowA == columnA)*rowB, lenB):
+            if (not ppt) or (columnB >= rowB):
+                monomial = productA * productsB[rowB][columnB]
+            else:
+                monomial = productA * productsB[columnB][rowB]
+            # Apply the substitutions if any
+            monomial = apply_substitutions(monomial, substitutions,
+                                           pure_substitution_rules)
+            entries.append((rowB, columnB, monomial))
+    return rowA, columnA, entries
 
 
 def split_commutative_parts(e):
@@ -672,6 +678,26 @@ def is_number_type(exp):
     return isinstance(exp, (int, float, complex)) or exp.is_number
 
 
+def is_expanded(polynomial):
+    """Check whether a polynomial is already a sum of monomials, in which case
+    expanding it would not change it.
+    """
+    if polynomial.is_Add:
+        terms = polynomial.args
+    else:
+        terms = (polynomial,)
+    for term in terms:
+        if term.is_Mul:
+            factors = term.args
+        else:
+            factors = (term,)
+        for factor in factors:
+            if factor.is_Add or (factor.is_Pow and (factor.base.is_Add or
+                                                    factor.base.is_Mul)):
+                return False
+    return True
+
+
 def is_adjoint(exp):
     return isinstance(exp, (adjoint, conjugate))
 
@@ -9,7 +9,7 @@ from math import sqrt
 from sympy import S
 from sympy.physics.quantum.dagger import Dagger
 from .sdp_relaxation import SdpRelaxation
-from .nc_utils import apply_substitutions, is_number_type, ncdegree, \
+from .nc_utils import is_number_type, ncdegree, \
     separate_scalar_factor
 
 
@@ -72,8 +72,7 @@ class RdmHierarchy(SdpRelaxation):
         self.m_block = 0
 
     def _push_monomials(self, monomials, n_vars, row_offset, coords, N):
-        monomial0 = apply_substitutions(monomials[0], self.substitutions,
-                                        self.pure_substitution_rules)
+        monomial0 = self._substitute(monomials[0])
         for mon1 in monomials[1:]:
             self.moment_substitutions[mon1] = monomial0
         k, coeff = [], []
@@ -88,7 +87,7 @@ class RdmHierarchy(SdpRelaxation):
                 k += k1
                 coeff += coeff1
 
-        elif monomial0 != 0:
+        elif monomial0 is not S.Zero:
             entries = self._process_monomial(monomial0, n_vars)
             for entry in entries:
                 k1, coeff1 = entry
@@ -104,10 +103,7 @@ class RdmHierarchy(SdpRelaxation):
     def __second_moments(self, n_vars, monomialsA, block_index,
                          processed_entries):
         N = len(monomialsA)
-        row_offset = 0
-        if block_index > 0:
-            for block_size in self.block_struct[0:block_index]:
-                row_offset += block_size ** 2
+        row_offset = self._row_offsets[block_index]
         coords, mons =  \
             generate_block_coords(monomialsA[:N // 2], monomialsA[:N // 2],
                                   0, N // 2, 0, N // 2, 0, 0, N // 2)
@@ -131,10 +127,7 @@ class RdmHierarchy(SdpRelaxation):
         self.m_block += 1
         if self.m_block == 1 or self.m_block == 3:
             N = int(sqrt(len(monomialsA)))
-            row_offset = 0
-            if block_index > 0:
-                for block_size in self.block_struct[0:block_index]:
-                    row_offset += block_size ** 2
+            row_offset = self._row_offsets[block_index]
             for block_row in range(N):
                 monsA = monomialsA[N*block_row:N*(block_row+1)]
                 for block_col in range(block_row, N):
@@ -149,10 +142,7 @@ class RdmHierarchy(SdpRelaxation):
             return n_vars, block_index + 1, processed_entries
         elif self.m_block == 2:
             N = int(sqrt(len(monomialsA)//2))
-            row_offset = 0
-            if block_index > 0:
-                for block_size in self.block_struct[0:block_index]:
-                    row_offset += block_size ** 2
+            row_offset = self._row_offsets[block_index]
             for block_row in range(N):
                 monsA = monomialsA[N*block_row:N*(block_row+1)]
                 for block_col in range(block_row, N):
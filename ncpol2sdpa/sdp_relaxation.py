@@ -8,10 +8,11 @@ Created on Sun May 26 15:06:17 2013
 @author: Peter Wittek
 """
 from __future__ import division, print_function
+from array import array
 import sys
 from functools import partial
 import numpy as np
-from scipy.sparse import lil_matrix
+from scipy.sparse import coo_matrix, csr_matrix, hstack, lil_matrix, vstack
 from sympy import S, Expr, Add
 import time
 
@@ -31,10 +32,10 @@ except ImportError:
 
 from .nc_utils import apply_substitutions, \
     assemble_monomial_and_do_substitutions, convert_relational, \
-    find_variable_set, flatten, flip_sign, get_all_monomials, is_number_type, \
-    is_pure_substitution_rule, iscomplex, moment_of_entry, ncdegree, \
-    pick_monomials_up_to_degree, save_monomial_index, separate_scalar_factor, \
-    simplify_polynomial, unique
+    flatten, flip_sign, get_all_monomials, get_support_variables, \
+    is_expanded, is_number_type, is_pure_substitution_rule, iscomplex, \
+    moment_of_entry, ncdegree, pick_monomials_up_to_degree, \
+    save_monomial_index, separate_scalar_factor, simplify_polynomial, unique
 from .solver_common import find_solution_ranks, get_sos_decomposition, \
     get_xmat_value, solve_sdp, extract_dual_value
 from .cvxpy_utils import convert_to_cvxpy
@@ -173,6 +174,7 @@ class SdpRelaxation(Relaxation):
 
         # Variables related to generating the moment matrix
         self.var_offsets = [0]
+        self._row_offsets = [0]
         self.variables = []
         self.normalized = normalized
         self.substitutions = {}
@@ -181,6 +183,12 @@ class SdpRelaxation(Relaxation):
         self.level = 0
         self.moment_substitutions = {}
         self.complex_matrix = False
+        self._F_rows, self._F_cols, self._F_vals = None, None, None
+        self._substitution_cache = {}
+        self._adjoint_cache = {}
+        self._index_cache = {}
+        self._localizing_cache = {}
+        self._variable_set_index = None
 
         # Variables related to processing constraints
         self.localizing_monomial_sets = None
@@ -208,20 +216,18 @@ class SdpRelaxation(Relaxation):
                 self.variables = unique(variables)
         else:
             self.variables = [variables]
-        for vs in self.variables:
-            if not isinstance(vs, list) and not isinstance(vs, tuple):
-                vs = [vs]
-            for v in vs:
-                if v.is_commutative and (v.is_hermitian is None or
-                                         v.is_hermitian):
-                    n_commutative_hermitian += 1
-                elif v.is_commutative:
-                    n_commutative_nonhermitian += 1
-                elif not v.is_commutative and (v.is_hermitian is None or
-                                               v.is_hermitian):
-                    n_noncommutative_hermitian += 1
-                else:
-                    n_noncommutative_nonhermitian += 1
+        flat_variables = flatten([self.variables])
+        for v in flat_variables:
+            if v.is_commutative and (v.is_hermitian is None or
+                                     v.is_hermitian):
+                n_commutative_hermitian += 1
+            elif v.is_commutative:
+                n_commutative_nonhermitian += 1
+            elif not v.is_commutative and (v.is_hermitian is None or
+                                           v.is_hermitian):
+                n_noncommutative_hermitian += 1
+            else:
+                n_noncommutative_nonhermitian += 1
         self.parameters = parameters
         info = ""
         if n_commutative_hermitian > 0:
@@ -266,6 +272,26 @@ class SdpRelaxation(Relaxation):
     # ROUTINES RELATED TO GENERATING THE MOMENT MATRICES                   #
     ########################################################################
 
+    def _substitute(self, monomial):
+        """Applies the substitution rules to a monomial."""
+        try:
+            return self._substitution_cache[monomial]
+        except KeyError:
+            result = apply_substitutions(monomial, self.substitutions,
+                                         self.pure_substitution_rules)
+            self._substitution_cache[monomial] = result
+            return result
+
+    def _adjoint(self, monomial):
+        """Return the memoized adjoint of a monomial.
+        """
+        try:
+            return self._adjoint_cache[monomial]
+        except KeyError:
+            result = monomial.adjoint()
+            self._adjoint_cache[monomial] = result
+            return result
+
     def _process_monomial(self, monomial, n_vars):
         """Process a single monomial when building the moment matrix.
         """
@@ -306,8 +332,7 @@ class SdpRelaxation(Relaxation):
                     # If we have seen the conjugate before, we just use the
                     # conjugate monomial instead
                         processed_monomial_adjoint = \
-                              apply_substitutions(processed_monomial.adjoint(),
-                                                  self.substitutions)
+                            self._substitute(self._adjoint(processed_monomial))
                         k = self.monomial_index[processed_monomial_adjoint]
                     except KeyError:
                         # Otherwise we define a new entry in the associated
@@ -327,35 +352,77 @@ class SdpRelaxation(Relaxation):
             return self._push_monomial(self.moment_substitutions[monomial], n_vars, row_offset,
                                        rowA, columnA, N,
                                        rowB, columnB, lenB, prevent_substitutions)
+        row = row_offset + rowA * N*lenB + rowB * N + columnA * lenB + columnB
         if is_number_type(monomial):
             if rowA == 0 and columnA == 0 and rowB == 0 and columnB == 0 and \
                     monomial == 1.0:
                 if not self.normalized:
                     n_vars += 1
-                    self.F[row_offset + rowA * N*lenB + rowB * N +
-                           columnA * lenB + columnB, n_vars] = 1
+                    k, value = n_vars, 1
                 else:
-                    self.F[row_offset + rowA * N*lenB + rowB * N +
-                           columnA*lenB + columnB, 0] = float(self.normalized)
+                    k, value = 0, float(self.normalized)
+            elif iscomplex(monomial):
+                k, value = 0, complex(monomial)
             else:
-                self.F[row_offset + rowA * N*lenB + rowB * N +
-                       columnA * lenB + columnB, 0] = monomial
+                k, value = 0, float(monomial)
+            self._F_rows.append(row)
+            self._F_cols.append(k)
+            self._F_vals.append(value)
         elif monomial.is_Add:
             for element in monomial.args:
                 n_vars = self._push_monomial(element, n_vars, row_offset,
                                              rowA, columnA, N,
                                              rowB, columnB, lenB, True)
-        elif monomial != 0:
+        elif monomial is not S.Zero:
             entries = self._process_monomial(monomial, n_vars)
             for entry in entries:
                 k, coeff = entry
                 # We push the entry to the moment matrix
-                self.F[row_offset + rowA * N*lenB + rowB * N +
-                       columnA * lenB + columnB, k] = coeff
+                self._F_rows.append(row)
+                self._F_cols.append(k)
+                self._F_vals.append(coeff)
                 if k > n_vars:
                     n_vars = k
         return n_vars
 
+    def __reset_moment_matrix_entries(self):
+        """Start new buffers for the entries pushed by _push_monomial. Typed
+        arrays take a fraction of the memory of lists of Python objects and
+        are handed over to NumPy without copying.
+        """
+        self._F_rows, self._F_cols = array('l'), array('l')
+        if self.F.dtype == np.float64:
+            self._F_vals = array('d')
+        else:
+            self._F_vals = []
+
+    def __flush_moment_matrix_entries(self):
+        """Write the entries collected by _push_monomial to F in one batch.
+        """
+        if len(self._F_rows) > 0:
+            # A C long is only 32 bits wide on some platforms, which is not
+            # enough for the keys below. The copies also release the buffers,
+            # so that they can be emptied afterwards.
+            rows = np.frombuffer(self._F_rows,
+                                 dtype=np.dtype(self._F_rows.typecode)
+                                 ).astype(np.int64)
+            columns = np.frombuffer(self._F_cols,
+                                    dtype=np.dtype(self._F_cols.typecode)
+                                    ).astype(np.int64)
+            values = np.array(self._F_vals, dtype=self.F.dtype)
+            # The same entry can be pushed more than once, in which case the
+            # last value wins, exactly as with item assignment
+            keys = rows * self.F.shape[1] + columns
+            _, last = np.unique(keys[::-1], return_index=True)
+            last = len(keys) - 1 - last
+            last = last[values[last] != 0]
+            entries = coo_matrix((values[last], (rows[last], columns[last])),
+                                 shape=self.F.shape, dtype=self.F.dtype)
+            if self.F.getnnz() > 0:
+                entries = entries.tocsr() + self.F.tocsr()
+            self.F = entries.tolil()
+            del self._F_rows[:], self._F_cols[:], self._F_vals[:]
+
     def _generate_moment_matrix(self, n_vars, block_index, processed_entries,
                                 monomialsA, monomialsB, ppt=False):
         """Generate the moment matrix of monomials.
@@ -365,65 +432,66 @@ class SdpRelaxation(Relaxation):
         block_index -- current block index in the SDP matrix
         monomials -- |W_d| set of words of length up to the relaxation level
         """
-        row_offset = 0
-        if block_index > 0:
-            for block_size in self.block_struct[0:block_index]:
-                row_offset += block_size ** 2
-        N = len(monomialsA)*len(monomialsB)
+        row_offset = self._row_offsets[block_index]
+        lenA, lenB = len(monomialsA), len(monomialsB)
+        N = lenA*lenB
+        # The adjoints are computed once per block rather than once per entry,
+        # and so are the products of the second party
+        daggered_monomialsB = [monomial.adjoint() for monomial in monomialsB]
         func = partial(assemble_monomial_and_do_substitutions,
-                       monomialsA=monomialsA, monomialsB=monomialsB, ppt=ppt,
+                       monomialsA=monomialsA,
+                       daggered_monomialsA=[monomial.adjoint()
+                                            for monomial in monomialsA],
+                       productsB=[[daggered * monomial
+                                   for monomial in monomialsB]
+                                  for daggered in daggered_monomialsB],
+                       ppt=ppt,
                        substitutions=self.substitutions,
                        pure_substitution_rules=self.pure_substitution_rules)
+        # The subblocks of the upper triangle are independent of each other,
+        # so the whole block is streamed through the pool in the same order as
+        # the serial loop. Only _push_monomial, which assigns the SDP
+        # variables, has to stay serial.
+        subblocks = ((rowA, columnA)
+                     for rowA in range(lenA)
+                     for columnA in range(rowA, lenA))
         if self._parallel:
             pool = Pool()
             # This is just a guess and can be optimized
-            chunksize = int(max(int(np.sqrt(len(monomialsA) * len(monomialsB) *
-                                        len(monomialsA) / 2) / cpu_count()),
-                                1))
-        for rowA in range(len(monomialsA)):
-            if self._parallel:
-                iter_ = pool.map(func, [(rowA, columnA, rowB, columnB)
-                                        for rowB in range(len(monomialsB))
-                                        for columnA in range(rowA,
-                                                             len(monomialsA))
-                                        for columnB in range((rowA == columnA)*rowB,
-                                                             len(monomialsB))],
-                                 chunksize)
-                print_criterion = processed_entries + len(iter_)
-            else:
-                iter_ = imap(func, [(rowA, columnA, rowB, columnB)
-                                    for columnA in range(rowA, len(monomialsA))
-                                    for rowB in range(len(monomialsB))
-                                    for columnB in range((rowA == columnA)*rowB,
-                                                         len(monomialsB))])
-            for columnA, rowB, columnB, monomial in iter_:
+            chunksize = int(max(np.sqrt(lenA * lenA / 2) / cpu_count(), 1))
+            iter_ = pool.imap(func, subblocks, chunksize)
+        else:
+            iter_ = imap(func, subblocks)
+        push_monomial = self._push_monomial
+        for subblock, (rowA, columnA, entries) in enumerate(iter_):
+            for rowB, columnB, monomial in entries:
                 processed_entries += 1
-                n_vars = self._push_monomial(monomial, n_vars,
-                                             row_offset, rowA,
-                                             columnA, N, rowB,
-                                             columnB, len(monomialsB),
-                                             prevent_substitutions=True)
-                if self.verbose > 0 and (not self._parallel or
-                                         processed_entries == self.n_vars or
-                                         processed_entries == print_criterion):
-                    percentage = processed_entries / self.n_vars
-                    time_used = time.time()-self._time0
-                    eta = (1.0 / percentage) * time_used - time_used
-                    hours = int(eta/3600)
-                    minutes = int((eta-3600*hours)/60)
-                    seconds = eta-3600*hours-minutes*60
-
-                    msg = ""
-                    if self.verbose > 1 and self._parallel:
-                        msg = ", working on block {:0} with {:0} processes with a chunksize of {:0d}"\
-                              .format(block_index, cpu_count(),
-                                      chunksize)
-                    msg = "{:0} (done: {:.2%}, ETA {:02d}:{:02d}:{:03.1f}"\
-                          .format(n_vars, percentage, hours, minutes, seconds) + \
-                          msg
-                    msg = "\r\x1b[KCurrent number of SDP variables: " + msg + ")"
-                    sys.stdout.write(msg)
-                    sys.stdout.flush()
+                n_vars = push_monomial(monomial, n_vars, row_offset, rowA,
+                                       columnA, N, rowB, columnB, lenB,
+                                       prevent_substitutions=True)
+            # In parallel mode, the progress is reported once per chunk of
+            # subblocks
+            if self.verbose > 0 and (not self._parallel or
+                                     processed_entries == self.n_vars or
+                                     (subblock + 1) % chunksize == 0):
+                percentage = processed_entries / self.n_vars
+                time_used = time.time()-self._time0
+                eta = (1.0 / percentage) * time_used - time_used
+                hours = int(eta/3600)
+                minutes = int((eta-3600*hours)/60)
+                seconds = eta-3600*hours-minutes*60
+
+                msg = ""
+                if self.verbose > 1 and self._parallel:
+                    msg = ", working on block {:0} with {:0} processes with a chunksize of {:0d}"\
+                          .format(block_index, cpu_count(),
+                                  chunksize)
+                msg = "{:0} (done: {:.2%}, ETA {:02d}:{:02d}:{:03.1f}"\
+                      .format(n_vars, percentage, hours, minutes, seconds) + \
+                      msg
+                msg = "\r\x1b[KCurrent number of SDP variables: " + msg + ")"
+                sys.stdout.write(msg)
+                sys.stdout.flush()
 
         if self._parallel:
             pool.close()
@@ -464,15 +532,23 @@ class SdpRelaxation(Relaxation):
                                daggered=False):
         """Returns the index of a monomial.
         """
+        key = (element, enablesubstitution, daggered)
+        try:
+            return self._index_cache[key]
+        except KeyError:
+            result = self.__get_index_of_monomial(element, enablesubstitution,
+                                                  daggered)
+            self._index_cache[key] = result
+            return result
+
+    def __get_index_of_monomial(self, element, enablesubstitution, daggered):
         result = []
         processed_element, coeff1 = separate_scalar_factor(element)
         if processed_element in self.moment_substitutions:
             r = self._get_index_of_monomial(self.moment_substitutions[processed_element], enablesubstitution)
             return [(k, coeff*coeff1) for k, coeff in r]
         if enablesubstitution:
-            processed_element = \
-                apply_substitutions(processed_element, self.substitutions,
-                                    self.pure_substitution_rules)
+            processed_element = self._substitute(processed_element)
         # Given the monomial, we need its mapping L_y(w) to push it into
         # a corresponding constraint matrix
         if is_number_type(processed_element):
@@ -488,10 +564,12 @@ class SdpRelaxation(Relaxation):
                 result.append((0, coeff))
                 continue
             k = -1
-            if monomial != 0:
-                if monomial.as_coeff_Mul()[0] < 0:
+            if monomial is not S.Zero:
+                # The coefficient is a SymPy number, whose is_negative is far
+                # cheaper than a rich comparison
+                if monomial.as_coeff_Mul()[0].is_negative:
                     monomial = -monomial
-                    coeff = -1.0 * coeff
+                    coeff = -coeff
             try:
                 new_element = self.moment_substitutions[monomial]
                 r = self._get_index_of_monomial(self.moment_substitutions[new_element], enablesubstitution)
@@ -502,17 +580,31 @@ class SdpRelaxation(Relaxation):
                     result.append((k, coeff))
                 except KeyError:
                     if not daggered:
-                        dag_result = self._get_index_of_monomial(monomial.adjoint(),
-                                                                 daggered=True)
-                        result += [(k, coeff0*coeff) for k, coeff0 in dag_result]
+                        # The substituted adjoint is usually a monomial that
+                        # is already indexed, so we look it up directly and
+                        # only take the full recursive route if it is not
+                        adjoint = self._adjoint(monomial)
+                        dag_monomial, coeff0 = \
+                            separate_scalar_factor(self._substitute(adjoint))
+                        if dag_monomial not in self.moment_substitutions and \
+                                dag_monomial in self.monomial_index:
+                            result.append((self.monomial_index[dag_monomial],
+                                           coeff0*coeff))
+                        else:
+                            dag_result = \
+                                self._get_index_of_monomial(adjoint,
+                                                            daggered=True)
+                            result += [(k, coeff0*coeff)
+                                       for k, coeff0 in dag_result]
                     else:
                         raise RuntimeError("The requested monomial " +
                                            str(monomial) + " could not be found.")
         return result
 
-    def __push_facvar_sparse(self, polynomial, block_index, row_offset, i, j):
+    def __push_facvar_sparse(self, polynomial, block_index, row_offset, i, j,
+                             entries):
         """Calculate the sparse vector representation of a polynomial
-        and pushes it to the F structure.
+        and pushes it to the entries of the block it belongs to.
         """
         width = self.block_struct[block_index - 1]
         # Preprocess the polynomial for uniform handling later
@@ -526,12 +618,17 @@ class SdpRelaxation(Relaxation):
         else:
             elements = polynomial.as_coeff_mul()[1][0].as_coeff_add()[1]
         # Identify its constituent monomials
+        rows, columns, values = entries
+        get_index_of_monomial = self._get_index_of_monomial
+        row = row_offset + i * width + j
         for element in elements:
-            results = self._get_index_of_monomial(element)
+            results = get_index_of_monomial(element)
             # k identifies the mapped value of a word (monomial) w
             for (k, coeff) in results:
                 if k > -1 and coeff != 0:
-                    self.F[row_offset + i * width + j, k] += coeff
+                    rows.append(row)
+                    columns.append(k)
+                    values.append(coeff)
 
     def _get_facvar(self, polynomial):
         """Return dense vector representation of a polynomial. This function is
@@ -539,21 +636,43 @@ class SdpRelaxation(Relaxation):
         sparse entries to the constraint matrices, it returns a dense
         vector.
         """
-        facvar = [0] * (self.n_vars + 1)
+        ks, coeffs = self.__get_facvar_entries(polynomial)
+        # The coefficients of repeated indices are summed in a single scatter
+        facvar = np.zeros(self.n_vars + 1, dtype=coeffs.dtype)
+        np.add.at(facvar, ks, coeffs)
+        return facvar
+
+    def __get_facvar_entries(self, polynomial):
+        """Return the indices and coefficients of the sparse vector
+        representation of a polynomial. Repeated indices are not summed.
+        """
         # Preprocess the polynomial for uniform handling later
         if is_number_type(polynomial):
-            facvar[0] = polynomial
-            return facvar
-        polynomial = polynomial.expand()
-        if polynomial.is_Mul:
-            elements = [polynomial]
+            if iscomplex(polynomial):
+                ks, coeffs = [0], [complex(polynomial)]
+            else:
+                ks, coeffs = [0], [float(polynomial)]
         else:
-            elements = polynomial.as_coeff_mul()[1][0].as_coeff_add()[1]
-        for element in elements:
-            results = self._get_index_of_monomial(element)
-            for (k, coeff) in results:
-                facvar[k] += coeff
-        return facvar
+            # Both the objective and the entries of the equality constraints
+            # arrive simplified, so expanding them again is wasted work
+            if not is_expanded(polynomial):
+                polynomial = polynomial.expand()
+            if polynomial.is_Mul:
+                elements = [polynomial]
+            else:
+                elements = polynomial.as_coeff_mul()[1][0].as_coeff_add()[1]
+            ks, coeffs = [], []
+            for element in elements:
+                results = self._get_index_of_monomial(element)
+                for (k, coeff) in results:
+                    ks.append(k)
+                    coeffs.append(coeff)
+        # The vector is real unless a coefficient really is complex, so that
+        # writers such as the SDPA one do not see complex zeros
+        coeffs = np.asarray(coeffs, dtype=np.complex128)
+        if not np.any(coeffs.imag):
+            coeffs = coeffs.real
+        return np.asarray(ks, dtype=np.intp), coeffs
 
     def __process_inequalities(self, block_index):
         """Generate localizing matrices
@@ -565,10 +684,15 @@ class SdpRelaxation(Relaxation):
                        SDP relaxation
         """
         initial_block_index = block_index
-        row_offsets = [0]
-        for block, block_size in enumerate(self.block_struct):
-            row_offsets.append(row_offsets[block] + block_size ** 2)
-
+        row_offsets = self._row_offsets
+        push_facvar_sparse = self.__push_facvar_sparse
+
+        # The localizing matrices are assembled block by block and stacked
+        # into F in one go, rather than assigned entry by entry to F
+        n_columns = self.F.shape[1]
+        blocks = [coo_matrix((row_offsets[initial_block_index], n_columns),
+                             dtype=self.F.dtype)]
+        string_constraints = []
         if self._parallel:
             pool = Pool()
         for k, ineq in enumerate(self.constraints):
@@ -576,13 +700,21 @@ class SdpRelaxation(Relaxation):
             monomials = self.localizing_monomial_sets[block_index -
                                                       initial_block_index-1]
             lm = len(monomials)
+            first_row = row_offsets[block_index-1]
             if isinstance(ineq, str):
-                self.__parse_expression(ineq, row_offsets[block_index-1])
+                # The expression may refer to any localizing matrix, so it is
+                # parsed once all of them are in F
+                string_constraints.append((ineq, first_row))
+                blocks.append(coo_matrix((row_offsets[block_index] -
+                                          first_row, n_columns),
+                                         dtype=self.F.dtype))
                 continue
             if ineq.is_Relational:
                 ineq = convert_relational(ineq)
-            func = partial(moment_of_entry, monomials=monomials, ineq=ineq,
-                           substitutions=self.substitutions)
+            func = partial(moment_of_entry, monomials=monomials,
+                           daggered_monomials=[monomial.adjoint()
+                                               for monomial in monomials],
+                           ineq=ineq, substitutions=self.substitutions)
             if self._parallel and lm > 1:
                 chunksize = max(int(np.sqrt(lm*lm/2) /
                                     cpu_count()), 1)
@@ -597,16 +729,22 @@ class SdpRelaxation(Relaxation):
                 is_equality = True
             else:
                 is_equality = False
+            entries = [], [], []
             for row, column, polynomial in iter_:
                 if is_equality:
                     row, column = 0, 0
-                self.__push_facvar_sparse(polynomial, block_index,
-                                          row_offsets[block_index-1],
-                                          row, column)
+                push_facvar_sparse(polynomial, block_index,
+                                   row_offsets[block_index-1] - first_row,
+                                   row, column, entries)
                 if is_equality:
                     block_index += 1
             if is_equality:
                 block_index -= 1
+            rows, columns, values = entries
+            blocks.append(coo_matrix((values, (rows, columns)),
+                                     shape=(row_offsets[block_index] -
+                                            first_row, n_columns),
+                                     dtype=self.F.dtype))
             if self.verbose > 0:
                 sys.stdout.write("\r\x1b[KProcessing %d/%d constraints..." %
                                  (k+1, len(self.constraints)))
@@ -614,6 +752,13 @@ class SdpRelaxation(Relaxation):
         if self._parallel:
             pool.close()
             pool.join()
+        if len(self.constraints) > 0:
+            blocks.append(coo_matrix((self.F.shape[0] -
+                                      row_offsets[block_index], n_columns),
+                                     dtype=self.F.dtype))
+            self.F = (self.F.tocsr() + vstack(blocks, format='csr')).tolil()
+        for ineq, first_row in string_constraints:
+            self.__parse_expression(ineq, first_row)
 
         if self.verbose > 0:
             sys.stdout.write("\n")
@@ -641,10 +786,9 @@ class SdpRelaxation(Relaxation):
                                     "Choose a higher level of relaxation."
                                     % eq_order)
                 localization_order = (2 * self.level - eq_order)//2
-                index = find_variable_set(self.variables, equality)
+                index = self.__find_variable_set(equality)
                 localizing_monomials = \
-                    pick_monomials_up_to_degree(self.monomial_sets[index],
-                                                localization_order)
+                    self.__pick_localizing_monomials(index, localization_order)
                 if len(localizing_monomials) == 0:
                     localizing_monomials = [S.One]
                 localizing_monomials = unique(localizing_monomials)
@@ -656,12 +800,16 @@ class SdpRelaxation(Relaxation):
                 le += 1
                 monomial_sets.append([S.One])
                 n_rows += 1
-        A = np.zeros((n_rows, self.n_vars + 1), dtype=self.F.dtype)
+        # Each row only has a handful of nonzeros, so A is collected as
+        # triplets rather than allocated densely
+        A_rows, A_cols, A_vals = [], [], []
         n_rows = 0
         if self._parallel:
             pool = Pool()
         for i, equality in enumerate(flatten([equalities, momentequalities])):
             func = partial(moment_of_entry, monomials=monomial_sets[i],
+                           daggered_monomials=[monomial.adjoint() for monomial
+                                               in monomial_sets[i]],
                            ineq=equality, substitutions=self.substitutions)
             lm = len(monomial_sets[i])
             if self._parallel and lm > 1:
@@ -677,9 +825,17 @@ class SdpRelaxation(Relaxation):
             for row, column, polynomial in iter_:
                 # Calculate the moments of polynomial entries
                 if isinstance(polynomial, str):
-                    self.__parse_expression(equality, -1, A[n_rows])
+                    line = np.zeros(self.n_vars + 1, dtype=self.F.dtype)
+                    self.__parse_expression(equality, -1, line)
+                    columns = np.nonzero(line)[0]
+                    values = line[columns]
                 else:
-                    A[n_rows] = self._get_facvar(polynomial)
+                    # The entries go straight into A without a dense vector
+                    # in between; repeated columns are summed by coo_matrix
+                    columns, values = self.__get_facvar_entries(polynomial)
+                A_rows.extend([n_rows] * len(columns))
+                A_cols.extend(columns)
+                A_vals.extend(values)
                 n_rows += 1
                 if self.verbose > 0:
                     sys.stdout.write("\r\x1b[KProcessing %d/%d equalities..." %
@@ -691,13 +847,20 @@ class SdpRelaxation(Relaxation):
 
         if self.verbose > 0:
             sys.stdout.write("\n")
-        return A
+        return coo_matrix((A_vals, (A_rows, A_cols)),
+                          shape=(n_rows, self.n_vars + 1),
+                          dtype=self.F.dtype)
 
     def __remove_equalities(self, equalities, momentequalities):
         """Attempt to remove equalities by solving the linear equations.
         """
-        A = self.__process_equalities(equalities, momentequalities)
-        if min(A.shape != np.linalg.matrix_rank(A)):
+        A = self.__process_equalities(equalities, momentequalities).tocsc()
+        # SciPy has no sparse pivoted QR, so the factorization is done
+        # densely, but only on the columns of the variables that occur in the
+        # equalities. The other variables are carried over unchanged.
+        nonzero_columns = np.nonzero(A.getnnz(axis=0))[0]
+        if min(A.shape != np.linalg.matrix_rank(
+                A[:, nonzero_columns].toarray())):
             print("Warning: equality constraints are linearly dependent! "
                   "Results might be incorrect.", file=sys.stderr)
         if A.shape[0] == 0:
@@ -705,24 +868,36 @@ class SdpRelaxation(Relaxation):
         c = np.array(self.obj_facvar)
         if self.verbose > 0:
             print("QR decomposition...")
-        Q, R = np.linalg.qr(A[:, 1:].T, mode='complete')
+        variables = nonzero_columns[nonzero_columns > 0] - 1
+        others = np.setdiff1d(np.arange(self.n_vars), variables)
+        Q, R = np.linalg.qr(A[:, variables + 1].toarray().T, mode='complete')
         n = np.max(np.nonzero(np.sum(np.abs(R), axis=1) > 0)) + 1
-        x = np.dot(Q[:, :n], np.linalg.solve(np.transpose(R[:n, :]), -A[:, 0]))
-        self._new_basis = lil_matrix(Q[:, n:])
+        b = A[:, 0].toarray().ravel()
+        x = np.zeros(self.n_vars, dtype=np.result_type(Q, b))
+        x[variables] = np.dot(Q[:, :n],
+                              np.linalg.solve(np.transpose(R[:n, :]), -b))
+        null_space = Q[:, n:]
+        null_rows, null_columns = np.nonzero(null_space)
+        self._new_basis = coo_matrix(
+            (np.concatenate((np.ones(len(others)),
+                             null_space[null_rows, null_columns])),
+             (np.concatenate((others, variables[null_rows])),
+              np.concatenate((np.arange(len(others)),
+                              len(others) + null_columns)))),
+            shape=(self.n_vars, len(others) + null_space.shape[1])).tocsr()
         # Transforming the objective function
         self._original_obj_facvar = self.obj_facvar
         self._original_constant_term = self.constant_term
         self.obj_facvar = self._new_basis.T.dot(c)
         self.constant_term += c.dot(x)
         x = np.append(1, x)
-        # Transforming the moment matrix and localizing matrices
-        new_F = lil_matrix((self.F.shape[0], self._new_basis.shape[1] + 1))
-        new_F[:, 0] = self.F[:, :self.n_vars+1].dot(x).reshape((new_F.shape[0],
-                                                                1))
-        new_F[:, 1:] = self.F[:, 1:self.n_vars+1].\
-            dot(self._new_basis)
+        # Transforming the moment matrix and localizing matrices. The
+        # products are done in CSR, which is much faster than LIL.
+        F = self.F.tocsr()[:, :self.n_vars+1]
+        new_constant = csr_matrix(F.dot(x).reshape((F.shape[0], 1)))
         self._original_F = self.F
-        self.F = new_F
+        self.F = hstack([new_constant, F[:, 1:].dot(self._new_basis)],
+                        format='lil')
         self.n_vars = self._new_basis.shape[1]
         if self.verbose > 0:
             print("Number of variables after solving the linear equations: %d"
@@ -730,49 +905,47 @@ class SdpRelaxation(Relaxation):
 
     def __duplicate_momentmatrix(self, original_n_vars, n_vars, block_index):
         self.var_offsets.append(n_vars)
-        row_offset = 0
-        for block_size in self.block_struct[0:block_index]:
-            row_offset += block_size ** 2
+        row_offset = self._row_offsets[block_index]
         width = self.block_struct[0]
-        for row in range(width**2):
-            self.F[row_offset + row, n_vars+1:n_vars + original_n_vars+2] =\
-                self.F[row, :original_n_vars+1]
+        original = self.F[:width**2, :original_n_vars+1].tocoo()
+        self._F_rows.extend((row_offset + original.row).tolist())
+        self._F_cols.extend((n_vars + 1 + original.col).tolist())
+        self._F_vals.extend(original.data.tolist())
+        self.__flush_moment_matrix_entries()
         return n_vars + original_n_vars + 1, block_index + 1
 
     def __add_new_momentmatrix(self, n_vars, block_index):
         self.var_offsets.append(n_vars)
-        row_offset = 0
-        for block_size in self.block_struct[0:block_index]:
-            row_offset += block_size ** 2
+        row_offset = self._row_offsets[block_index]
         width = self.block_struct[0]
-        for i in range(width):
-            for j in range(i, width):
-                n_vars += 1
-                self.F[row_offset + i * width + j, n_vars] = 1
-        return n_vars, block_index + 1
+        rows, columns = np.triu_indices(width)
+        self._F_rows.extend((row_offset + rows * width + columns).tolist())
+        self._F_cols.extend(range(n_vars + 1, n_vars + len(rows) + 1))
+        self._F_vals.extend([1] * len(rows))
+        self.__flush_moment_matrix_entries()
+        return n_vars + len(rows), block_index + 1
 
     def __impose_ppt(self, block_index):
-        row_offset = 0
-        for block_size in self.block_struct[0:block_index-1]:
-            row_offset += block_size ** 2
+        row_offset = self._row_offsets[block_index-1]
         lenA = len(self.monomial_sets[0])
         lenB = len(self.monomial_sets[1])
         N = lenA*lenB
-        for rowA in range(lenA):
-            for columnA in range(rowA, lenA):
-                for rowB in range(lenB):
-                    start_columnB = 0
-                    if rowA == columnA:
-                        start_columnB = rowB
-                    for columnB in range(start_columnB, rowB):
-                        orig_row = self.F[row_offset + rowA*N*lenB + rowB * N +
-                                          columnA * lenB + columnB]
-                        self.F[row_offset + rowA*N*lenB + rowB * N +
-                               columnA * lenB + columnB] = \
-                            self.F[row_offset + rowA*N*lenB + columnB * N +
-                                   columnA * lenB + rowB]
-                        self.F[row_offset + rowA*N*lenB + columnB * N +
-                               columnA * lenB + rowB] = orig_row
+        # The partial transpose swaps the rows of the entries with
+        # rowA < columnA and columnB < rowB with their transposed counterparts,
+        # which is done as a single row permutation
+        rowA, columnA, rowB, columnB = \
+            np.meshgrid(range(lenA), range(lenA), range(lenB), range(lenB),
+                        indexing='ij')
+        mask = (rowA < columnA) & (columnB < rowB)
+        rowA, columnA = rowA[mask], columnA[mask]
+        rowB, columnB = rowB[mask], columnB[mask]
+        rows = row_offset + rowA*N*lenB + rowB*N + columnA*lenB + columnB
+        transposed_rows = row_offset + rowA*N*lenB + columnB*N + \
+            columnA*lenB + rowB
+        permutation = np.arange(self.F.shape[0])
+        permutation[rows] = transposed_rows
+        permutation[transposed_rows] = rows
+        self.F = self.F.tocsr()[permutation].tolil()
 
     def __add_extra_momentmatrices(self, extramomentmatrices, n_vars,
                                    block_index):
@@ -820,8 +993,7 @@ class SdpRelaxation(Relaxation):
                         value = -1.0
                     else:
                         value = 1.0
-                    base_row_offset = sum([bs**2 for bs in
-                                           self.block_struct[:mm_ind]])
+                    base_row_offset = self._row_offsets[mm_ind]
                     width = self.block_struct[mm_ind]
                     if row_offset > -1:
                         self.F[row_offset] += \
@@ -840,6 +1012,50 @@ class SdpRelaxation(Relaxation):
     # ROUTINES RELATED TO INITIALIZING DATA STRUCTURES                     #
     ########################################################################
 
+    def __index_variable_sets(self):
+        """Map each variable to the indices of the variable sets containing
+        it, so that the set of a constraint is found without scanning all
+        the sets.
+        """
+        if len(self.variables) > 0 and isinstance(self.variables[0], list):
+            self._variable_set_index = {}
+            for i, variable_set in enumerate(self.variables):
+                for variable in variable_set:
+                    self._variable_set_index.setdefault(variable,
+                                                        set()).add(i)
+        else:
+            self._variable_set_index = None
+
+    def __find_variable_set(self, polynomial):
+        """Return the index of the first variable set that contains the
+        support of a polynomial, or -1 if there is none.
+        """
+        if self._variable_set_index is None:
+            return 0
+        candidates = None
+        for variable in get_support_variables(polynomial):
+            variable_sets = self._variable_set_index.get(variable, set())
+            if candidates is None:
+                candidates = variable_sets
+            else:
+                candidates = candidates & variable_sets
+        if candidates is None:
+            return 0
+        elif len(candidates) == 0:
+            return -1
+        return min(candidates)
+
+    def __pick_localizing_monomials(self, index, localization_order):
+        """Returns the monomials of a set up to the localization order."""
+        key = (index, localization_order)
+        try:
+            return self._localizing_cache[key]
+        except KeyError:
+            monomials = pick_monomials_up_to_degree(self.monomial_sets[index],
+                                                    localization_order)
+            self._localizing_cache[key] = monomials
+            return monomials
+
     def _calculate_block_structure(self, inequalities, equalities,
                                    momentinequalities, momentequalities,
                                    extramomentmatrix, removeequalities,
@@ -901,10 +1117,10 @@ class SdpRelaxation(Relaxation):
                         self.localizing_monomial_sets[k] is not None:
                     localizing_monomials = self.localizing_monomial_sets[k]
                 else:
-                    index = find_variable_set(self.variables, constraint)
+                    index = self.__find_variable_set(constraint)
                     localizing_monomials = \
-                        pick_monomials_up_to_degree(self.monomial_sets[index],
-                                                    localization_order)
+                        self.__pick_localizing_monomials(index,
+                                                         localization_order)
                 ln = len(localizing_monomials)
                 if ln == 0:
                     localizing_monomials = [S.One]
@@ -993,9 +1209,7 @@ class SdpRelaxation(Relaxation):
         return new_n_vars, block_index
 
     def __wipe_F_from_constraints(self):
-        row_offset = 0
-        for block in range(self.constraint_starting_block):
-            row_offset += self.block_struct[block]**2
+        row_offset = self._row_offsets[self.constraint_starting_block]
         for row in range(row_offset, len(self.F.rows)):
             self.F.rows[row] = []
             self.F.data[row] = []
@@ -1112,12 +1326,19 @@ class SdpRelaxation(Relaxation):
                         value = -1.0
                     else:
                         value = 1.0
-                    base_row_offset = sum([bs**2 for bs in
-                                           self.block_struct[:mm_ind]])
+                    base_row_offset = self._row_offsets[mm_ind]
                     width = self.block_struct[mm_ind]
                     for column in self.F[base_row_offset + i*width + j].rows[0]:
-                        self.obj_facvar[column-1] = \
+                        entry = \
                             value*self.F[base_row_offset + i*width + j, column]
+                        # The objective only becomes complex if the moment
+                        # matrix element really has an imaginary part
+                        if np.imag(entry) != 0:
+                            self.obj_facvar = \
+                                self.obj_facvar.astype(np.complex128)
+                        elif not np.iscomplexobj(self.obj_facvar):
+                            entry = np.real(entry)
+                        self.obj_facvar[column-1] = entry
 
     def __getitem__(self, index):
         """Obtained the value for a polynomial in a solved relaxation.
@@ -1365,21 +1586,24 @@ class SdpRelaxation(Relaxation):
                     self.pure_substitution_rules = False
                 if iscomplex(lhs) or iscomplex(rhs):
                     self.complex_matrix = True
+        self._substitution_cache = {}
+        self._index_cache = {}
         if momentsubstitutions is not None:
             self.moment_substitutions = momentsubstitutions.copy()
             # If we have a real-valued problem, the moment matrix is symmetric
             # and moment substitutions also apply to the conjugate monomials
             if not self.complex_matrix:
                 for key, val in self.moment_substitutions.copy().items():
-                    adjoint_monomial = apply_substitutions(key.adjoint(),
-                                                           self.substitutions)
+                    adjoint_monomial = self._substitute(self._adjoint(key))
                     self.moment_substitutions[adjoint_monomial] = val
         if chordal_extension:
             self.variables = find_variable_cliques(self.variables, objective,
                                                    inequalities, equalities,
                                                    momentinequalities,
                                                    momentequalities)
+        self.__index_variable_sets()
         self.__generate_monomial_sets(extramonomials)
+        self._localizing_cache = {}
         self.localizing_monomial_sets = localizing_monomials
 
         # Figure out basic structure of the SDP
@@ -1387,6 +1611,9 @@ class SdpRelaxation(Relaxation):
                                         momentinequalities, momentequalities,
                                         extramomentmatrices,
                                         removeequalities)
+        self._row_offsets = [0]
+        for block_size in self.block_struct:
+            self._row_offsets.append(self._row_offsets[-1] + block_size**2)
         self._estimate_n_vars()
         if extramomentmatrices is not None:
             for parameters in extramomentmatrices:
@@ -1402,8 +1629,9 @@ class SdpRelaxation(Relaxation):
             dtype = np.complex128
         else:
             dtype = np.float64
-        self.F = lil_matrix((sum([bs**2 for bs in self.block_struct]),
-                                    self.n_vars + 1), dtype=dtype)
+        self.F = lil_matrix((self._row_offsets[-1], self.n_vars + 1),
+                            dtype=dtype)
+        self.__reset_moment_matrix_entries()
 
         if self.verbose > 0:
             print(('Estimated number of SDP variables: %d' % self.n_vars))
@@ -1413,6 +1641,7 @@ class SdpRelaxation(Relaxation):
         self._time0 = time.time()
         new_n_vars, block_index = \
             self._generate_all_moment_matrix_blocks(new_n_vars, block_index)
+        self.__flush_moment_matrix_entries()
         if extramomentmatrices is not None:
             new_n_vars, block_index = \
                 self.__add_extra_momentmatrices(extramomentmatrices,
@@ -260,8 +260,11 @@ def write_to_sdpa(sdp, filename):
                 .replace(']', ')'))
     file_.write(' = BlocStructure\n')
     # c vector (objective)
-    objective = \
-        str(list(sdp.obj_facvar)).replace('[', '').replace(']', '')
+    obj_facvar = np.real_if_close(sdp.obj_facvar)
+    if np.iscomplexobj(obj_facvar):
+        raise Exception("The SDPA format does not support complex "
+                        "coefficients in the objective function!")
+    objective = ', '.join(str(value) for value in obj_facvar)
     if multiplier == 2:
         objective += ', ' + objective
     file_.write('{'+objective+'}\n')
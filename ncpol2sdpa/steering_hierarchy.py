@@ -10,9 +10,8 @@ Created on Sun May 26 15:06:17 2013
 from __future__ import division, print_function
 import os
 from sympy import S, zeros
-from sympy.physics.quantum.dagger import Dagger
 import tempfile
-from .nc_utils import apply_substitutions, is_number_type
+from .nc_utils import is_number_type
 from .sdp_relaxation import SdpRelaxation
 from .sdpa_utils import write_to_sdpa
 
@@ -91,9 +90,7 @@ class SteeringHierarchy(SdpRelaxation):
         except KeyError:
             # An extra round of substitutions is granted on the conjugate of
             # the monomial if all the variables are Hermitian
-            daggered_monomial = \
-                apply_substitutions(Dagger(monomial), self.substitutions,
-                                    self.pure_substitution_rules)
+            daggered_monomial = self._substitute(self._adjoint(monomial))
             try:
                 k = self.monomial_index[daggered_monomial]
                 conjugate = True
@@ -109,8 +106,7 @@ class SteeringHierarchy(SdpRelaxation):
 
     def _push_monomial(self, monomial, n_vars, row_offset, rowA, columnA, N,
                        rowB, columnB, lenB, prevent_substitutions=False):
-        monomial = apply_substitutions(monomial, self.substitutions,
-                                       self.pure_substitution_rules)
+        monomial = self._substitute(monomial)
         if is_number_type(monomial):
             if rowA == 0 and columnA == 0 and rowB == 0 and columnB == 0 and \
                     monomial == 1.0 and not self.normalized:
@@ -131,7 +127,7 @@ class SteeringHierarchy(SdpRelaxation):
                 n_vars = self._push_monomial(element, n_vars, row_offset,
                                              rowA, columnA, N,
                                              rowB, columnB, lenB)
-        elif monomial != 0:
+        elif monomial is not S.Zero:
             k, coeff = self._process_monomial(monomial, n_vars)
             # We push the entry to the moment matrix
             if self.matrix_var_dim is None:
@@ -195,8 +191,7 @@ class SteeringHierarchy(SdpRelaxation):
             for j in range(self.matrix_var_dim):
                 for key, value in \
                         polynomial[i, j].as_coefficients_dict().items():
-                    skey = apply_substitutions(key, self.substitutions,
-                                               self.pure_substitution_rules)
+                    skey = self._substitute(key)
                     try:
                         Fk = F[skey]
                     except KeyError:
@@ -1,6 +1,8 @@
+import os
+import tempfile
 import unittest
 import numpy as np
-from sympy import S, expand
+from sympy import I, S, expand
 from sympy.physics.quantum.dagger import Dagger
 from ncpol2sdpa import bosonic_constraints, \
                        define_objective_with_I, fermionic_constraints, \
@@ -104,6 +106,84 @@ class ChshMixedLevel(unittest.TestCase):
         self.assertTrue(abs(relaxation.primal + (np.sqrt(2)-1)/2) < 10e-5)
 
 
+class ComplexExtraObjective(unittest.TestCase):
+
+    def tearDown(self):
+        clear_cache()
+
+    def test_complex_moment_in_objective(self):
+        a = generate_operators('a', 2)
+        relaxation = SdpRelaxation(a)
+        relaxation.get_relaxation(2, objective=Dagger(a[0])*a[0],
+                                  substitutions={a[0]*a[1]: I*a[1]*a[0]},
+                                  extraobjexpr="0[17,19]")
+        obj_facvar = relaxation.obj_facvar
+        self.assertTrue(np.allclose(obj_facvar[obj_facvar != 0], [1, 1j]))
+
+
+class ComplexMomentEqualities(unittest.TestCase):
+
+    def tearDown(self):
+        clear_cache()
+
+    def test_removed_equalities_keep_imaginary_parts(self):
+        a = generate_operators('a', 2)
+        relaxation = SdpRelaxation(a)
+        relaxation.get_relaxation(2, objective=Dagger(a[0])*a[0],
+                                  substitutions={a[0]*a[1]: I*a[1]*a[0]},
+                                  momentequalities=[Dagger(a[0])*a[0] - 1],
+                                  removeequalities=True)
+        self.assertEqual(relaxation.F.dtype, np.complex128)
+        self.assertTrue(np.max(np.abs(relaxation.F.toarray().imag)) > 0)
+
+
+class ComplexSdpaFile(unittest.TestCase):
+
+    def tearDown(self):
+        clear_cache()
+
+    def test_real_objective(self):
+        a = generate_operators('a', 2)
+        relaxation = SdpRelaxation(a)
+        relaxation.get_relaxation(1, objective=Dagger(a[0])*a[0] +
+                                  Dagger(a[1])*a[1],
+                                  substitutions={a[0]*a[1]: I*a[1]*a[0]})
+        self.assertTrue(relaxation.complex_matrix)
+        handle, filename = tempfile.mkstemp(suffix='.dat-s')
+        os.close(handle)
+        try:
+            relaxation.write_to_file(filename)
+            with open(filename) as file_:
+                objective = file_.read().splitlines()[4]
+        finally:
+            os.remove(filename)
+        self.assertTrue(objective.startswith('{') and objective.endswith('}'))
+        values = [float(value) for value in objective[1:-1].split(',')]
+        self.assertEqual(sum(values), 4)
+
+    def test_real_moment_in_objective(self):
+        a = generate_operators('a', 2)
+        relaxation = SdpRelaxation(a)
+        relaxation.get_relaxation(1, objective=Dagger(a[0])*a[0],
+                                  substitutions={a[0]*a[1]: I*a[1]*a[0]},
+                                  extraobjexpr="0[1,1]")
+        self.assertTrue(relaxation.complex_matrix)
+        self.assertFalse(np.iscomplexobj(relaxation.obj_facvar))
+        handle, filename = tempfile.mkstemp(suffix='.dat-s')
+        os.close(handle)
+        try:
+            relaxation.write_to_file(filename)
+            with open(filename) as file_:
+                objective = file_.read().splitlines()[4]
+        finally:
+            os.remove(filename)
+        self.assertNotIn('j', objective)
+        values = [float(value) for value in objective[1:-1].split(',')]
+        n_vars = relaxation.n_vars
+        self.assertEqual(values[:n_vars], values[n_vars:])
+        self.assertTrue(any(values))
+
+
 class ElegantBell(unittest.TestCase):
 
     def tearDown(self):
@@ -162,6 +242,29 @@ class ExampleNoncommutative(unittest.TestCase):
         self.assertTrue(abs(self.sdpRelaxation.primal + 0.75) < 10e-5)
 
 
+class FactorizedEqualities(unittest.TestCase):
+
+    def tearDown(self):
+        clear_cache()
+
+    def test_factorized_equalities(self):
+        x = generate_variables('x', 2, commutative=True)
+        objective = x[0]*x[1] - x[1]
+        factorized = SdpRelaxation(x)
+        factorized.get_relaxation(2, objective=objective,
+                                  equalities=[(x[0] - 1)*(x[0] + 1)],
+                                  removeequalities=True)
+        expanded = SdpRelaxation(x)
+        expanded.get_relaxation(2, objective=objective,
+                                equalities=[x[0]**2 - 1],
+                                removeequalities=True)
+        self.assertTrue(np.allclose(factorized.F.toarray(),
+                                    expanded.F.toarray()))
+        polynomial = (x[0] + 1)*(x[1] - x[0])
+        self.assertTrue(np.allclose(expanded._get_facvar(polynomial),
+                                    expanded._get_facvar(expand(polynomial))))
+
+
 class FastSubstitute(unittest.TestCase):
 
     def tearDown(self):
@@ -376,5 +479,26 @@ class SparsePop(unittest.TestCase):
         self.assertTrue(abs(sdpRelaxation.primal + 2.2443690631722637) < 10e-5)
 
 
+class StringConstraint(unittest.TestCase):
+
+    def tearDown(self):
+        clear_cache()
+
+    def test_reference_to_localizing_matrix(self):
+        x = generate_variables('x', 2)
+        relaxation = SdpRelaxation(x)
+        relaxation.get_relaxation(2, objective=x[0]*x[1],
+                                  inequalities=[1 - x[0]**2,
+                                                "1[0,1]+0[0,1]-0.5"])
+        F = relaxation.F.toarray()
+        width = relaxation.block_struct[0]
+        first_row = width**2
+        row = first_row + relaxation.block_struct[1]**2
+        expected = F[first_row + 1] + F[1]
+        expected[0] -= 0.5
+        self.assertTrue(np.allclose(F[row], expected))
+        self.assertTrue(np.any(F[first_row + 1] != 0))
+
+
 if __name__ == '__main__':
     unittest.main()